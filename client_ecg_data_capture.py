@@ -13,13 +13,29 @@ Example:
 """
 
 import argparse
+import numpy as np
 import serial
 import time
 import csv
 import json
+import queue
 import sys
+import threading
 from datetime import datetime
 
+# orjson parses the small per-sample JSON payloads noticeably faster; it is optional
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# One captured row: elapsed time, raw and filtered ECG, BPM and the ESP32 timestamp.
+# Missing numeric values are stored as NaN and written back out as empty cells.
+# The timestamp is kept as the original object so strings of any length survive intact.
+SAMPLE_DTYPE = np.dtype([('time', 'f8'), ('raw', 'f8'), ('smoothed', 'f8'),
+                         ('bpm', 'f8'), ('timestamp', 'O')])
+MAX_SAMPLE_RATE = 200  # Hz, matches SAMPLING_RATE in latest_ecg_client_request.ino
+
 def print_flush(*args, **kwargs):
     """Print and flush immediately."""
     print(*args, **kwargs)
@@ -57,6 +73,72 @@ def select_port(ports):
         except ValueError:
             print("Please enter a number.")
 
+# Status messages printed by latest_ecg_client_request.ino, matched on their leading
+# text (after any status emoji) rather than by searching each line for every message
+STATUS_PREFIXES = (
+    ("Lead-off detected", "lead_off"),
+    ("Connected to Wi-Fi", "status"),
+    ("Reconnected to Wi-Fi", "status"),
+    ("Data sent successfully", "status"),
+    ("Fetal BPM:", "fetal_bpm"),
+    ("Maternal BPM:", "maternal_bpm"),
+)
+STATUS_SYMBOLS = "\u2705\u274c "  # Check mark and cross mark emoji used by the firmware
+
+def _status_kind(line):
+    """Return the kind of ESP32 status message in line, or None for other output."""
+    message = line.lstrip(STATUS_SYMBOLS)
+    for prefix, kind in STATUS_PREFIXES:
+        if message.startswith(prefix):
+            return kind
+    return None
+
+def _as_float(value):
+    """Convert an optional JSON number to float, using NaN for missing values."""
+    return np.nan if value is None else float(value)
+
+def _format_value(value):
+    """
+    Format a stored number for CSV output.
+    
+    Whole numbers (the firmware sends its readings and BPM as integers) are
+    written without a decimal point, anything else at full float precision.
+    """
+    if np.isnan(value):
+        return ''
+    return str(int(value)) if value.is_integer() else repr(float(value))
+
+def _store_row(buffer, index, row):
+    """Store a row in the capture buffer, doubling the buffer first if it is full."""
+    if index >= len(buffer):
+        grown = np.empty(2 * len(buffer), dtype=buffer.dtype)
+        grown[:index] = buffer[:index]
+        buffer = grown
+    buffer[index] = row
+    return buffer
+
+def _read_serial_lines(ser, lines, stop_event):
+    """
+    Move lines from the serial port into a queue until stop_event is set.
+    
+    Each line is queued together with its arrival time from time.monotonic_ns().
+    """
+    while not stop_event.is_set():
+        try:
+            line = ser.readline()
+        except serial.SerialException as e:
+            print_flush(f"Error reading from serial port: {e}")
+            break
+        if line:
+            item = (time.monotonic_ns(), line)
+            # Wait for room in the queue without missing a stop request
+            while not stop_event.is_set():
+                try:
+                    lines.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
 def capture_ecg_data(port, baud_rate, duration, output_file):
     """Capture ECG data from the ESP32 and save to CSV."""
     print_flush(f"Attempting to connect to ESP32 on {port} at {baud_rate} baud...")
@@ -78,106 +160,115 @@ def capture_ecg_data(port, baud_rate, duration, output_file):
     time.sleep(2)
     
     # Prepare for data capture
-    start_time = time.time()
-    data = []
+    start_ns = time.monotonic_ns()
+    end_ns = start_ns + int(duration * 1e9)
+    data = np.empty(max(1, int(duration * MAX_SAMPLE_RATE * 1.2)), dtype=SAMPLE_DTYPE)
+    row_count = 0
     sample_count = 0
-    last_print_time = start_time
+    last_print_ns = start_ns
     
     print_flush(f"Starting recording for {duration} seconds...")
     print_flush("Press Ctrl+C to stop recording early.")
     
+    # A reader thread drains the serial port so parsing never delays a read
+    lines = queue.Queue(maxsize=4096)
+    stop_event = threading.Event()
+    reader = threading.Thread(target=_read_serial_lines, args=(ser, lines, stop_event), daemon=True)
+    reader.start()
+    
     try:
-        while time.time() - start_time < duration:
-            if ser.in_waiting:
-                try:
-                    line = ser.readline().decode('utf-8', errors='ignore').strip()
-                    
-                    # Skip empty lines
-                    if not line:
-                        continue
-                    
-                    # Check for lead-off detection
-                    if "Lead-off detected" in line:
-                        print_flush("Warning: Leads are not properly connected!")
-                        elapsed = time.time() - start_time
-                        data.append([elapsed, None, None, None, "Lead-off detected"])
-                        continue
-                    
-                    # Check for WiFi connection messages
-                    if "Connected to Wi-Fi" in line or "Reconnected to Wi-Fi" in line:
-                        print_flush(f"ESP32: {line}")
-                        continue
-                    
-                    # Check for data sent confirmation
-                    if "Data sent successfully" in line:
-                        print_flush(f"ESP32: {line}")
-                        continue
-                    
-                    # Try to parse BPM information
-                    if "Fetal BPM:" in line:
-                        try:
-                            fetal_bpm = int(line.split(":")[1].strip())
-                            print_flush(f"Fetal BPM: {fetal_bpm}")
-                            continue
-                        except (ValueError, IndexError):
-                            continue
-                    
-                    if "Maternal BPM:" in line:
-                        try:
-                            maternal_bpm = int(line.split(":")[1].strip())
-                            print_flush(f"Maternal BPM: {maternal_bpm}")
-                            continue
-                        except (ValueError, IndexError):
-                            continue
-                    
-                    # Try to parse JSON payload
-                    if line.startswith("{") and line.endswith("}"):
-                        try:
-                            json_data = json.loads(line)
-                            
-                            timestamp = json_data.get("timestamp", datetime.now().isoformat())
-                            bpm = json_data.get("bpm", None)
-                            raw_ecg = json_data.get("rawEcg", None)
-                            smoothed_ecg = json_data.get("smoothedEcg", None)
-                            
-                            elapsed = time.time() - start_time
-                            data.append([elapsed, raw_ecg, smoothed_ecg, bpm, timestamp])
-                            sample_count += 1
+        while True:
+            try:
+                arrival_ns, raw_line = lines.get(timeout=0.1)
+            except queue.Empty:
+                # Stop when time is up, or when the reader has died (e.g. the device was unplugged)
+                if time.monotonic_ns() >= end_ns or not reader.is_alive():
+                    break
+                continue
+            if arrival_ns >= end_ns:
+                break
+            
+            try:
+                line = raw_line.decode('utf-8', errors='ignore').strip()
+                
+                # Skip empty lines
+                if not line:
+                    continue
+                
+                # JSON payloads are the bulk of the traffic, so check for them first
+                if line[0] == "{" and line[-1] == "}":
+                    try:
+                        json_data = json_loads(line)
+                        
+                        timestamp = json_data.get("timestamp", datetime.now().isoformat())
+                        bpm = json_data.get("bpm", None)
+                        raw_ecg = json_data.get("rawEcg", None)
+                        smoothed_ecg = json_data.get("smoothedEcg", None)
+                        
+                        elapsed = (arrival_ns - start_ns) * 1e-9
+                        data = _store_row(data, row_count,
+                                          (elapsed, _as_float(raw_ecg), _as_float(smoothed_ecg),
+                                           _as_float(bpm), timestamp))
+                        row_count += 1
+                        sample_count += 1
+                        
+                        # Print progress every second
+                        if arrival_ns - last_print_ns >= 1_000_000_000:
+                            print_flush(f"Captured {sample_count} samples in {elapsed:.1f} seconds")
+                            if bpm:
+                                print_flush(f"Current BPM: {bpm}")
+                            last_print_ns = arrival_ns
                             
-                            # Print progress every second
-                            current_time = time.time()
-                            if current_time - last_print_time >= 1.0:
-                                print_flush(f"Captured {sample_count} samples in {elapsed:.1f} seconds")
-                                if bpm:
-                                    print_flush(f"Current BPM: {bpm}")
-                                last_print_time = current_time
-                                
-                        except json.JSONDecodeError:
-                            # Not valid JSON, might be other debug output
-                            print_flush(f"Debug: {line}")
-                    else:
-                        # Other debug output
+                    except json.JSONDecodeError:
+                        # Not valid JSON, might be other debug output
                         print_flush(f"Debug: {line}")
-                
-                except Exception as e:
-                    print_flush(f"Error processing data: {e}")
                     continue
-    
+                
+                # Everything else is a status message or debug output
+                kind = _status_kind(line)
+                if kind == "lead_off":
+                    print_flush("Warning: Leads are not properly connected!")
+                    elapsed = (arrival_ns - start_ns) * 1e-9
+                    data = _store_row(data, row_count,
+                                      (elapsed, np.nan, np.nan, np.nan, "Lead-off detected"))
+                    row_count += 1
+                elif kind == "status":
+                    print_flush(f"ESP32: {line}")
+                elif kind in ("fetal_bpm", "maternal_bpm"):
+                    try:
+                        reported_bpm = int(line.split(":")[1].strip())
+                    except (ValueError, IndexError):
+                        continue
+                    label = "Fetal" if kind == "fetal_bpm" else "Maternal"
+                    print_flush(f"{label} BPM: {reported_bpm}")
+                else:
+                    # Other debug output
+                    print_flush(f"Debug: {line}")
+            
+            except Exception as e:
+                print_flush(f"Error processing data: {e}")
+                continue
+
     except KeyboardInterrupt:
         print_flush("\nRecording stopped by user.")
     finally:
+        stop_event.set()
+        reader.join(timeout=2)
         ser.close()
         print_flush("Serial port closed.")
     
     # Save data to CSV
-    if data:
+    if row_count:
+        data = data[:row_count]
         try:
             with open(output_file, 'w', newline='') as csvfile:
                 writer = csv.writer(csvfile)
                 writer.writerow(['Time (s)', 'Raw ECG', 'Filtered ECG', 'BPM', 'Timestamp'])
-                writer.writerows(data)
+                writer.writerows([repr(float(row['time'])), _format_value(row['raw']),
+                                  _format_value(row['smoothed']), _format_value(row['bpm']),
+                                  row['timestamp']] for row in data)
             
-            total_time = data[-1][0] - data[0][0] if len(data) > 1 else 0
+            total_time = data['time'][-1] - data['time'][0] if len(data) > 1 else 0
             
             print_flush(f"\nRecording Summary:")
             print_flush(f"- Total samples: {sample_count}")
@@ -59,8 +59,9 @@ void loop() {
   }
   filteredValue = sum / SAMPLES_TO_AVERAGE;
 
-  // Output only the raw value for compatibility with Python script
-  Serial.println(rawValue);
+  // Output only the raw value for compatibility with Python script,
+  // as the integer ADC code ("1234" rather than "1234.00")
+  Serial.println((int)rawValue);
 
   delayMicroseconds(2500);  // 400Hz sampling rate
 }
\ No newline at end of file
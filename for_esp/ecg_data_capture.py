@@ -17,9 +17,14 @@ import serial
 import time
 import csv
 import os
+import queue
 import sys
+import threading
 from datetime import datetime
 
+# First bytes of a sample line: the firmware prints each reading as a plain number
+SAMPLE_START_BYTES = b'0123456789+-.'
+
 def print_flush(*args, **kwargs):
     """Print and flush immediately."""
     print(*args, **kwargs)
@@ -27,9 +32,9 @@ def print_flush(*args, **kwargs):
 
 def parse_arguments():
     """Parse command line arguments."""
-    parser = argparse.ArgumentParser(description='Capture raw ECG data from Arduino with AD8232 sensor')
+    parser = argparse.ArgumentParser(description='Capture raw ECG data from ESP32 with AD8232 sensor')
     parser.add_argument('--port', type=str, default=None,
-                        help='Serial port (e.g., COM3, /dev/ttyUSB0)')
+                        help='Serial port (e.g., COM6, /dev/ttyUSB0)')
     parser.add_argument('--baud', type=int, default=115200,
                         help='Baud rate (default: 115200)')
     parser.add_argument('--duration', type=float, default=30.0,
@@ -70,6 +75,47 @@ def select_port(ports):
         except ValueError:
             print("Please enter a number.")
 
+def enable_low_latency(ser):
+    """
+    Ask the serial driver to pass bytes on as soon as they arrive.
+    
+    USB serial adapters otherwise hold received bytes for their latency timer
+    (16 ms on FTDI), so samples reach us in clumps. On Linux this sets the
+    ASYNC_LOW_LATENCY flag; on Windows it enlarges the driver's receive buffer.
+    """
+    if hasattr(ser, 'set_low_latency_mode'):
+        try:
+            ser.set_low_latency_mode(True)
+        except ValueError as e:
+            # Not every driver supports the flag; capture still works without it
+            print_flush(f"Low-latency mode not available: {e}")
+    elif hasattr(ser, 'set_buffer_size'):
+        ser.set_buffer_size(rx_size=65536)
+
+def _read_serial_chunks(ser, chunks, stop_event):
+    """
+    Move bytes from the serial port into a queue until stop_event is set.
+    
+    Each read takes everything the port has buffered (waiting up to the port
+    timeout for at least one byte) and is queued together with its arrival
+    time from time.perf_counter_ns().
+    """
+    while not stop_event.is_set():
+        try:
+            data = ser.read(max(1, ser.in_waiting))
+        except serial.SerialException as e:
+            print_flush(f"Error reading from serial port: {e}")
+            break
+        if data:
+            item = (time.perf_counter_ns(), data)
+            # Wait for room in the queue without missing a stop request
+            while not stop_event.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
 def capture_raw_data(port, baud_rate, duration, output_file):
     """Capture raw ECG data from the ESP32 and save to CSV."""
     print_flush(f"Attempting to connect to ESP32 on {port} at {baud_rate} baud...")
@@ -86,6 +132,7 @@ def capture_raw_data(port, baud_rate, duration, output_file):
         return False
     
     print_flush("Successfully connected to ESP32!")
+    enable_low_latency(ser)
     print_flush("Waiting for device to reset...")
     
     # Wait for ESP32 to reset
@@ -98,23 +145,70 @@ def capture_raw_data(port, baud_rate, duration, output_file):
             print_flush("Device initialized successfully")
             break
     
+    # Open the output file up front and write rows as they arrive, so memory
+    # use stays flat however long the recording runs
+    try:
+        csvfile = open(output_file, 'w', newline='', buffering=65536)
+    except OSError as e:
+        print_flush(f"Error opening output file {output_file}: {e}")
+        ser.close()
+        return False
+    writer = csv.writer(csvfile)
+    writer.writerow(['Time (s)', 'Raw ECG Value'])
+    
     # Prepare for data capture
-    start_time = time.time()
-    data = []
+    start_ns = time.perf_counter_ns()
+    end_ns = start_ns + int(duration * 1e9)
     sample_count = 0
-    last_print_time = start_time
+    first_time = last_time = 0.0
+    last_print_ns = start_ns
     expected_sample_rate = 400  # Hz (from Arduino code's 2500 microseconds delay)
     
     print_flush(f"Starting recording for {duration} seconds...")
     print_flush(f"Expected sampling rate: {expected_sample_rate} Hz")
     print_flush("Press Ctrl+C to stop recording early.")
     
+    # A reader thread drains the serial port so parsing and file writes never delay a read
+    chunks = queue.Queue(maxsize=4096)
+    stop_event = threading.Event()
+    reader = threading.Thread(target=_read_serial_chunks, args=(ser, chunks, stop_event), daemon=True)
+    reader.start()
+    
+    # Bytes received after the last complete line, and when the previous chunk arrived
+    pending = bytearray()
+    prev_ns = start_ns
+    
     try:
-        while time.time() - start_time < duration:
-            if ser.in_waiting:
-                try:
-                    line = ser.readline().decode('utf-8', errors='ignore').strip()
-                
+        while True:
+            try:
+                now_ns, data = chunks.get(timeout=0.1)
+            except queue.Empty:
+                # Stop when time is up, or when the reader has died (e.g. the device was unplugged)
+                if time.perf_counter_ns() >= end_ns or not reader.is_alive():
+                    break
+                continue
+            if now_ns >= end_ns:
+                break
+            chunk_start_ns, prev_ns = prev_ns, now_ns
+            
+            # Split off the complete lines, leaving the unfinished tail in place
+            pending += data
+            end = pending.rfind(b'\n')
+            if end < 0:
+                continue
+            lines = pending[:end].split(b'\n')
+            del pending[:end + 1]
+            
+            # Arrival time of this chunk
+            time_sec = (now_ns - start_ns) * 1e-9
+            batch = []
+            
+            for raw_line in lines:
+                # Nearly every line is a sample, so only decode the ones that
+                # cannot be a number to look for status messages
+                if not raw_line or raw_line[0] not in SAMPLE_START_BYTES:
+                    line = raw_line.decode('utf-8', errors='ignore').strip()
+                    
                     # Handle lead-off detection
                     if line == "Leads off!":
                         print_flush("Warning: Leads are not properly connected!")
@@ -122,58 +216,64 @@ def capture_raw_data(port, baud_rate, duration, output_file):
                     
                     # Skip header or empty lines
                     if not line or line == "raw":
-                    continue
-                
-                    # Parse the raw value
-                try:
-                        raw_value = float(line)
-                        time_sec = time.time() - start_time
-                        data.append([time_sec, raw_value])
-                        sample_count += 1
-                        
-                        # Print progress every second
-                        current_time = time.time()
-                        if current_time - last_print_time >= 1.0:
-                            elapsed = current_time - start_time
-                            current_rate = sample_count / elapsed if elapsed > 0 else 0
-                            print_flush(f"Captured {sample_count} samples in {elapsed:.1f} seconds ({current_rate:.1f} Hz)")
-                            last_print_time = current_time
-                    
-                    except ValueError:
-                        print_flush(f"Skipping invalid data: {line}")
                         continue
                 
-                except UnicodeDecodeError:
-                    print_flush("Received invalid data from device")
+                # Parse the raw value (float() accepts bytes and ignores the line ending)
+                try:
+                    raw_value = float(raw_line)
+                except ValueError:
+                    print_flush(f"Skipping invalid data: {raw_line.decode('utf-8', errors='ignore').strip()}")
                     continue
+                
+                batch.append(f"{raw_value:g}")
+            
+            # Write the batch's rows in one call. We only learn when each chunk
+            # arrived, so the chunk's samples are spaced evenly over the interval
+            # since the previous chunk: each time is accurate to about one chunk
+            # interval (a few ms, up to the adapter's 16 ms latency timer when
+            # low-latency mode is unavailable), while consecutive samples keep
+            # distinct times with close to the true spacing.
+            if batch:
+                offset_ns = chunk_start_ns - start_ns
+                step_ns = (now_ns - chunk_start_ns) / len(batch)
+                writer.writerows((f"{(offset_ns + (k + 1) * step_ns) * 1e-9:.6f}", value)
+                                 for k, value in enumerate(batch))
+                if not sample_count:
+                    first_time = (offset_ns + step_ns) * 1e-9
+                last_time = time_sec
+                sample_count += len(batch)
+            
+            # Print progress every second
+            if now_ns - last_print_ns >= 1_000_000_000:
+                current_rate = sample_count / time_sec if time_sec > 0 else 0
+                print_flush(f"Captured {sample_count} samples in {time_sec:.1f} seconds ({current_rate:.1f} Hz)")
+                last_print_ns = now_ns
     
     except KeyboardInterrupt:
         print_flush("\nRecording stopped by user.")
+    except OSError as e:
+        print_flush(f"Error saving data to file: {e}")
+        return False
     finally:
+        stop_event.set()
+        reader.join(timeout=2)
         ser.close()
         print_flush("Serial port closed.")
+        csvfile.close()
     
-    # Save data to CSV
-    if data:
-        try:
-        with open(output_file, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['Time (s)', 'Raw ECG Value'])
-            writer.writerows(data)
+    if sample_count:
+        total_time = last_time - first_time
+        actual_rate = sample_count / total_time if total_time > 0 else 0
         
-            total_time = data[-1][0] - data[0][0]
-            actual_rate = len(data) / total_time if total_time > 0 else 0
-            
-            print_flush(f"\nRecording Summary:")
-            print_flush(f"- Total samples: {sample_count}")
-            print_flush(f"- Recording duration: {total_time:.1f} seconds")
-            print_flush(f"- Average sampling rate: {actual_rate:.1f} Hz")
-            print_flush(f"- Data saved to: {output_file}")
+        print_flush(f"\nRecording Summary:")
+        print_flush(f"- Total samples: {sample_count}")
+        print_flush(f"- Recording duration: {total_time:.1f} seconds")
+        print_flush(f"- Average sampling rate: {actual_rate:.1f} Hz")
+        print_flush(f"- Data saved to: {output_file}")
         return True
-        except Exception as e:
-            print_flush(f"Error saving data to file: {e}")
-            return False
     else:
+        # Don't leave a header-only file behind
+        os.remove(output_file)
         print_flush("No data was captured. Please check if:")
         print_flush("1. The electrodes are properly connected")
         print_flush("2. The ESP32 is powered and running")
@@ -182,17 +282,7 @@ def capture_raw_data(port, baud_rate, duration, output_file):
 
 def main():
     """Main function."""
-    parser = argparse.ArgumentParser(description='Capture raw ECG data from ESP32 with AD8232 sensor')
-    parser.add_argument('--port', type=str, default=None,
-                        help='Serial port (e.g., COM6, /dev/ttyUSB0)')
-    parser.add_argument('--baud', type=int, default=115200,
-                        help='Baud rate (default: 115200)')
-    parser.add_argument('--duration', type=float, default=30.0,
-                        help='Recording duration in seconds (default: 30.0)')
-    parser.add_argument('--output', type=str, default=None,
-                        help='Output CSV file (default: ecg_data_YYYYMMDD_HHMMSS.csv)')
-    
-    args = parser.parse_args()
+    args = parse_arguments()
     
     # Use COM6 if no port specified
     if args.port is None:
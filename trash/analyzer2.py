@@ -1,36 +1,44 @@
 import numpy as np
 from scipy import signal
-import matplotlib.pyplot as plt
+import matplotlib
 import csv
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Batch runs without a display can skip the interactive backend entirely
+if os.environ.get('HEADLESS'):
+    matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+MAX_PLOT_POINTS = 4000  # More points than this are not visible at typical figure sizes
+DETECTION_RATE = 100  # Hz, enough for both filter bands (up to 40 Hz) when downsampling
 
-def detect_r_peaks(ecg_signal, sampling_rate, min_distance=0.2, prominence=0.5, is_fetal=False):
+@lru_cache(maxsize=16)
+def _butter_bandpass(order, low, high):
+    """Design (and cache) a float32 Butterworth bandpass in second-order sections."""
+    # Filtering in float32 can move a detected R peak by ±1 sample compared to float64
+    return signal.butter(order, [low, high], btype='band', output='sos').astype(np.float32)
+
+def bandpass_filter(ecg_signal, sampling_rate, is_fetal=False):
     """
-    Detect R peaks in the ECG signal.
+    Apply the maternal or fetal bandpass filter to the ECG signal.
     
     Parameters:
     -----------
     ecg_signal : array-like
-        The ECG signal to analyze
+        The ECG signal to filter
     sampling_rate : int
         Sampling rate of the signal in Hz
-    min_distance : float
-        Minimum distance between peaks in seconds
-    prominence : float
-        Minimum prominence of peaks
     is_fetal : bool
-        Whether to detect fetal ECG peaks (uses different parameters)
+        Whether to use the fetal band (10-40 Hz) instead of the maternal band (5-15 Hz)
         
     Returns:
     --------
-    peaks : array
-        Indices of detected R peaks
+    filtered_signal : array
+        Zero-phase filtered signal
     """
-    # Create a mask for valid data (not lead-off)
-    valid_mask = ecg_signal < 4095  # Values of 4095 indicate lead-off
-    
-    # Apply bandpass filter to remove noise
     nyquist = sampling_rate / 2
     
     if is_fetal:
@@ -42,34 +50,65 @@ def detect_r_peaks(ecg_signal, sampling_rate, min_distance=0.2, prominence=0.5,
         low = 5 / nyquist
         high = 15 / nyquist
     
-    b, a = signal.butter(4, [low, high], btype='band')
-    filtered_signal = signal.filtfilt(b, a, ecg_signal)
+    sos = _butter_bandpass(4, low, high)
+    return signal.sosfiltfilt(sos, ecg_signal)
+
+def detect_r_peaks(ecg_signal, sampling_rate, min_distance=0.2, prominence=0.5, is_fetal=False,
+                   valid_mask=None):
+    """
+    Detect R peaks in the ECG signal.
     
-    # Apply the mask to the filtered signal
-    masked_signal = np.copy(filtered_signal)
-    masked_signal[~valid_mask] = np.nan
+    Parameters:
+    -----------
+    ecg_signal : array-like
+        The ECG signal to analyze
+    sampling_rate : int
+        Sampling rate of the signal in Hz
+    min_distance : float
+        Minimum distance between peaks in seconds
+    prominence : float
+        Minimum prominence of peaks
+    is_fetal : bool
+        Whether to detect fetal ECG peaks (uses different parameters)
+    valid_mask : array, optional
+        Boolean mask of samples that are not lead-off; computed from ecg_signal if omitted
+        
+    Returns:
+    --------
+    peaks : array
+        Indices of detected R peaks
+    """
+    # Create a mask for valid data (not lead-off)
+    if valid_mask is None:
+        valid_mask = ecg_signal < 4095  # Values of 4095 indicate lead-off
     
-    # Find peaks using scipy's find_peaks
-    min_samples = int(min_distance * sampling_rate)
-    peaks, _ = signal.find_peaks(masked_signal, 
-                               distance=min_samples,
-                               prominence=prominence)
+    # Apply bandpass filter to remove noise
+    filtered_signal = bandpass_filter(ecg_signal, sampling_rate, is_fetal)
     
-    # If no peaks found, try with lower prominence
-    if len(peaks) == 0:
-        peaks, _ = signal.find_peaks(masked_signal, 
-                                   distance=min_samples,
-                                   prominence=prominence/2)
+    # Mask lead-off samples in place, the filter output is not needed afterwards
+    filtered_signal[~valid_mask] = np.nan
     
-    # If still no peaks, try with even lower prominence
-    if len(peaks) == 0:
-        peaks, _ = signal.find_peaks(masked_signal, 
-                                   distance=min_samples,
-                                   prominence=prominence/4)
+    # Find peaks once at the lowest prominence we are willing to accept.
+    # find_peaks applies the distance rule before the prominence rule, so
+    # keeping the peaks above a stricter prominence gives exactly the result
+    # of calling it again with that prominence.
+    min_samples = int(min_distance * sampling_rate)
+    peaks, properties = signal.find_peaks(filtered_signal, 
+                                          distance=min_samples,
+                                          prominence=prominence/4)
+    prominences = properties['prominences']
+    
+    # Use the strictest prominence that finds any peaks, relaxing it if needed.
+    # The largest prominence alone decides which tier that is.
+    if len(peaks) > 0:
+        top_prominence = prominences.max()
+        for min_prominence in (prominence, prominence/2):
+            if top_prominence >= min_prominence:
+                return peaks[prominences >= min_prominence]
     
     return peaks
 
-def separate_maternal_fetal_peaks(ecg_signal, sampling_rate):
+def separate_maternal_fetal_peaks(ecg_signal, sampling_rate, valid_mask=None):
     """
     Separate maternal and fetal R peaks from a combined ECG signal.
     
@@ -79,6 +118,8 @@ def separate_maternal_fetal_peaks(ecg_signal, sampling_rate):
         The combined ECG signal to analyze
     sampling_rate : int
         Sampling rate of the signal in Hz
+    valid_mask : array, optional
+        Boolean mask of samples that are not lead-off; computed from ecg_signal if omitted
         
     Returns:
     --------
@@ -87,39 +128,110 @@ def separate_maternal_fetal_peaks(ecg_signal, sampling_rate):
     fetal_peaks : array
         Indices of detected fetal R peaks
     """
-    # Detect maternal peaks (slower heart rate, larger amplitude)
-    maternal_peaks = detect_r_peaks(ecg_signal, sampling_rate, 
-                                  min_distance=0.6,  # ~100 BPM max
-                                  prominence=0.5,
-                                  is_fetal=False)
-    
-    # Detect fetal peaks (faster heart rate, smaller amplitude)
-    fetal_peaks = detect_r_peaks(ecg_signal, sampling_rate, 
-                               min_distance=0.3,  # ~200 BPM max
-                               prominence=0.2,
-                               is_fetal=True)
+    # The two bands are independent, and scipy's filter and peak-finding
+    # kernels release the GIL, so detect them on two threads
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # Detect maternal peaks (slower heart rate, larger amplitude)
+        maternal_future = executor.submit(detect_r_peaks, ecg_signal, sampling_rate,
+                                          min_distance=0.6,  # ~100 BPM max
+                                          prominence=0.5,
+                                          is_fetal=False,
+                                          valid_mask=valid_mask)
+        
+        # Detect fetal peaks (faster heart rate, smaller amplitude)
+        fetal_future = executor.submit(detect_r_peaks, ecg_signal, sampling_rate,
+                                       min_distance=0.3,  # ~200 BPM max
+                                       prominence=0.2,
+                                       is_fetal=True,
+                                       valid_mask=valid_mask)
+        
+        maternal_peaks = maternal_future.result()
+        fetal_peaks = fetal_future.result()
     
     # Remove peaks that are too close to each other (likely duplicates)
     if len(maternal_peaks) > 0 and len(fetal_peaks) > 0:
         # Create a mask for fetal peaks that are not too close to maternal peaks
         min_distance_samples = int(0.1 * sampling_rate)  # 100ms minimum distance
-        valid_fetal_peaks = []
         
-        for f_peak in fetal_peaks:
-            # Check if this fetal peak is far enough from all maternal peaks
-            is_valid = True
-            for m_peak in maternal_peaks:
-                if abs(f_peak - m_peak) < min_distance_samples:
-                    is_valid = False
-                    break
-            
-            if is_valid:
-                valid_fetal_peaks.append(f_peak)
+        # find_peaks returns peaks in ascending order, so only the nearest
+        # maternal peak on either side can be too close
+        idx = np.searchsorted(maternal_peaks, fetal_peaks)
+        left = maternal_peaks[np.maximum(idx - 1, 0)]
+        right = maternal_peaks[np.minimum(idx, len(maternal_peaks) - 1)]
+        nearest = np.minimum(np.abs(fetal_peaks - left), np.abs(fetal_peaks - right))
         
-        fetal_peaks = np.array(valid_fetal_peaks)
+        fetal_peaks = fetal_peaks[nearest >= min_distance_samples]
     
     return maternal_peaks, fetal_peaks
 
+def downsample_for_detection(ecg_signal, sampling_rate, lead_off_mask=None):
+    """
+    Decimate the ECG signal to about DETECTION_RATE for peak detection.
+    
+    Parameters:
+    -----------
+    ecg_signal : array-like
+        The ECG signal to decimate
+    sampling_rate : int
+        Sampling rate of the signal in Hz
+    lead_off_mask : array, optional
+        Boolean mask of lead-off samples; computed from ecg_signal if omitted
+        
+    Returns:
+    --------
+    decimated : array
+        Anti-alias filtered signal keeping every factor-th sample, with samples
+        whose block contains lead-off set back to 4095
+    factor : int
+        Decimation factor (1 if the signal is already slow enough)
+    """
+    factor = int(sampling_rate // DETECTION_RATE)
+    if factor < 2:
+        return ecg_signal, 1
+    
+    decimated = signal.decimate(ecg_signal, factor, ftype='fir', zero_phase=True)
+    
+    # Filtering smears the 4095 sentinel, so mark lead-off per block of samples
+    if lead_off_mask is None:
+        lead_off_mask = ecg_signal >= 4095
+    if lead_off_mask.any():
+        blocks = np.arange(0, len(ecg_signal), factor)
+        decimated[np.maximum.reduceat(lead_off_mask, blocks)] = 4095
+    
+    return decimated, factor
+
+def refine_peaks(ecg_signal, peaks, radius):
+    """
+    Move each peak to the largest valid sample within radius samples of it.
+    
+    Peaks with no valid (non lead-off) sample in their window are dropped.
+    
+    Parameters:
+    -----------
+    ecg_signal : array-like
+        The full-rate ECG signal
+    peaks : array
+        Approximate peak indices into ecg_signal
+    radius : int
+        Number of samples to search on either side of each peak
+        
+    Returns:
+    --------
+    peaks : array
+        Refined peak indices
+    """
+    if len(peaks) == 0:
+        return peaks
+    
+    window = np.clip(peaks[:, np.newaxis] + np.arange(-max(radius, 0), max(radius, 0) + 1),
+                     0, len(ecg_signal) - 1)
+    values = np.where(ecg_signal[window] < 4095, ecg_signal[window], -np.inf)
+    best = np.argmax(values, axis=1)
+    rows = np.arange(len(peaks))
+    # A window that is all lead-off has nothing to refine to
+    has_valid = values[rows, best] > -np.inf
+    return window[rows, best][has_valid]
+
 def calculate_heart_rate(peaks, sampling_rate, window_size=10):
     """
     Calculate heart rate from R peaks.
@@ -156,9 +268,9 @@ def calculate_heart_rate(peaks, sampling_rate, window_size=10):
     # Apply moving average
     window_samples = int(window_size * sampling_rate)
     if len(heart_rates) > window_samples:
-        heart_rates = np.convolve(heart_rates, 
-                                 np.ones(window_samples)/window_samples, 
-                                 mode='valid')
+        # Running sums give each window mean in O(1) instead of O(window)
+        cumulative = np.concatenate(([0.0], np.cumsum(heart_rates, dtype=np.float64)))
+        heart_rates = (cumulative[window_samples:] - cumulative[:-window_samples]) / window_samples
         times = times[window_samples-1:]
     
     return heart_rates, times
@@ -169,7 +281,7 @@ def calculate_average_heart_rate(heart_rates):
         return 0.0
     return np.mean(heart_rates)
 
-def analyze_ecg(ecg_signal, sampling_rate, window_size=10):
+def analyze_ecg(ecg_signal, sampling_rate, window_size=10, downsample=False):
     """
     Analyze ECG signal to detect maternal and fetal R peaks and calculate heart rates.
     
@@ -181,6 +293,10 @@ def analyze_ecg(ecg_signal, sampling_rate, window_size=10):
         Sampling rate of the signal in Hz
     window_size : int
         Size of the window for calculating moving average in seconds
+    downsample : bool
+        Detect peaks on a copy decimated to about DETECTION_RATE, then refine them
+        on the full-rate signal. Faster for long recordings, but peak positions can
+        differ by a few samples from full-rate detection.
         
     Returns:
     --------
@@ -200,14 +316,25 @@ def analyze_ecg(ecg_signal, sampling_rate, window_size=10):
         Average maternal heart rate in BPM
     fetal_avg_hr : float
         Average fetal heart rate in BPM
-    lead_off_mask : array
-        Boolean mask indicating lead-off periods
+    lead_off_spans : array
+        (start, end) sample index pairs of lead-off periods, end exclusive
     """
     # Create lead-off mask
     lead_off_mask = ecg_signal >= 4095
     
     # Detect maternal and fetal peaks
-    maternal_peaks, fetal_peaks = separate_maternal_fetal_peaks(ecg_signal, sampling_rate)
+    factor = 1
+    if downsample:
+        detection_signal, factor = downsample_for_detection(ecg_signal, sampling_rate,
+                                                            lead_off_mask)
+    if factor > 1:
+        maternal_peaks, fetal_peaks = separate_maternal_fetal_peaks(detection_signal,
+                                                                    sampling_rate / factor)
+        maternal_peaks = refine_peaks(ecg_signal, maternal_peaks * factor, factor // 2)
+        fetal_peaks = refine_peaks(ecg_signal, fetal_peaks * factor, factor // 2)
+    else:
+        maternal_peaks, fetal_peaks = separate_maternal_fetal_peaks(ecg_signal, sampling_rate,
+                                                                    ~lead_off_mask)
     
     # Calculate heart rates
     maternal_heart_rates, maternal_times = calculate_heart_rate(maternal_peaks, sampling_rate, window_size)
@@ -217,44 +344,59 @@ def analyze_ecg(ecg_signal, sampling_rate, window_size=10):
     maternal_avg_hr = calculate_average_heart_rate(maternal_heart_rates)
     fetal_avg_hr = calculate_average_heart_rate(fetal_heart_rates)
     
+    # Runs of lead-off samples start where the mask steps up and end where it steps down,
+    # so only these few indices are returned instead of the whole mask
+    edges = np.diff(lead_off_mask, prepend=False, append=False).nonzero()[0]
+    lead_off_spans = edges.reshape(-1, 2)
+    
     return (maternal_peaks, fetal_peaks, 
             maternal_heart_rates, fetal_heart_rates, 
             maternal_times, fetal_times, 
             maternal_avg_hr, fetal_avg_hr, 
-            lead_off_mask)
+            lead_off_spans)
+
+def reduce_for_plot(t, values, max_points=MAX_PLOT_POINTS):
+    """
+    Reduce a long trace to about max_points samples for plotting.
+    
+    The minimum and maximum of each bucket are kept (in time order), so
+    R peaks and other spikes stay visible unlike with plain striding.
+    """
+    bucket = len(values) // (max_points // 2)
+    if bucket < 2:
+        return t, values
+    
+    n_full = (len(values) // bucket) * bucket
+    buckets = values[:n_full].reshape(-1, bucket)
+    low = buckets.argmin(axis=1)
+    high = buckets.argmax(axis=1)
+    offsets = np.arange(len(buckets)) * bucket
+    
+    idx = np.column_stack((offsets + np.minimum(low, high),
+                           offsets + np.maximum(low, high))).ravel()
+    idx = np.concatenate((idx, np.arange(n_full, len(values))))
+    return t[idx], values[idx]
 
 def plot_analysis(t, ecg_signal, maternal_peaks, fetal_peaks, 
                  maternal_heart_rates, fetal_heart_rates, 
                  maternal_times, fetal_times, 
-                 maternal_avg_hr, fetal_avg_hr, lead_off_mask):
-    """Plot the ECG signal with detected maternal and fetal R peaks and heart rates."""
+                 maternal_avg_hr, fetal_avg_hr, lead_off_spans,
+                 output_image=None):
+    """
+    Plot the ECG signal with detected maternal and fetal R peaks and heart rates.
+    
+    The figure is shown interactively, or saved to output_image if given.
+    """
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 8), sharex=True)
     
     # Plot ECG with R peaks
-    ax1.plot(t, ecg_signal, label='ECG', color='blue')
+    ax1.plot(*reduce_for_plot(t, ecg_signal), label='ECG', color='blue')
     
     # Highlight lead-off periods
-    lead_off_periods = np.where(lead_off_mask)[0]
-    if len(lead_off_periods) > 0:
-        # Group consecutive indices
-        lead_off_groups = []
-        current_group = [lead_off_periods[0]]
-        
-        for i in range(1, len(lead_off_periods)):
-            if lead_off_periods[i] == lead_off_periods[i-1] + 1:
-                current_group.append(lead_off_periods[i])
-            else:
-                lead_off_groups.append(current_group)
-                current_group = [lead_off_periods[i]]
-        
-        lead_off_groups.append(current_group)
-        
-        # Highlight each group
-        for group in lead_off_groups:
-            if len(group) > 0:
-                start_idx = group[0]
-                end_idx = group[-1] + 1
-                ax1.axvspan(t[start_idx], t[end_idx-1], color='red', alpha=0.3, label='Lead Off')
+    for i, (start_idx, end_idx) in enumerate(lead_off_spans):
+        # Label only the first span so the legend lists 'Lead Off' once
+        ax1.axvspan(t[start_idx], t[end_idx-1], color='red', alpha=0.3,
+                    label='Lead Off' if i == 0 else None)
     
     # Plot maternal peaks
     if len(maternal_peaks) > 0:
@@ -293,7 +435,12 @@ def plot_analysis(t, ecg_signal, maternal_peaks, fetal_peaks,
     ax2.set_xlabel('Time (s)')
     
     plt.tight_layout()
-    plt.show()
+    if output_image is not None:
+        fig.savefig(output_image, dpi=100)
+        plt.close(fig)
+        print(f"Plot saved to {output_image}")
+    else:
+        plt.show()
 
 def load_ecg_from_csv(filename):
     """
@@ -313,19 +460,11 @@ def load_ecg_from_csv(filename):
     sampling_rate : int
         Estimated sampling rate in Hz
     """
-    t = []
-    ecg = []
-    
-    with open(filename, 'r', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        next(reader)  # Skip header row
-        for row in reader:
-            t.append(float(row[0]))
-            ecg.append(float(row[1]))  # Raw ADC value
-    
-    t = np.array(t)
-    ecg = np.array(ecg)
-    
+    # Parse the time and raw ADC columns in one pass, skipping the header row
+    data = np.loadtxt(filename, delimiter=',', skiprows=1, usecols=(0, 1), ndmin=2)
+    t = data[:, 0]
+    ecg = data[:, 1].astype(np.float32)  # Raw ADC value, 12-bit so float32 is exact
+
     # Estimate sampling rate
     if len(t) > 1:
         dt = np.mean(np.diff(t))
@@ -335,36 +474,61 @@ def load_ecg_from_csv(filename):
     
     return t, ecg, sampling_rate
 
+def _align_heart_rates(all_times, hr_times, heart_rates, tolerance=0.01):
+    """
+    Look up the heart rate measured within `tolerance` seconds of each time.
+    
+    `hr_times` must be sorted (as returned by calculate_heart_rate). Times
+    without a matching measurement are set to NaN.
+    """
+    column = np.full(len(all_times), np.nan)
+    if len(hr_times) == 0:
+        return column
+    
+    # The first match is the first measurement at or after (time - tolerance),
+    # or the one after it when rounding puts the former just outside the window
+    first = np.searchsorted(hr_times, all_times - tolerance, side='left')
+    for idx in (first + 1, first):
+        candidates = np.minimum(idx, len(hr_times) - 1)
+        matched = (idx < len(hr_times)) & (np.abs(hr_times[candidates] - all_times) < tolerance)
+        column[matched] = heart_rates[candidates[matched]]
+    return column
+
 def save_results_to_csv(t, ecg_signal, maternal_peaks, fetal_peaks, 
                        maternal_heart_rates, fetal_heart_rates, 
                        maternal_times, fetal_times, 
                        maternal_avg_hr, fetal_avg_hr, 
                        sampling_rate, output_filename="ecg_analysis_results.csv"):
     """Save analysis results to a CSV file."""
-    with open(output_filename, 'w', newline='') as csvfile:
+    # Build each section in memory and hand it to the writer in one call
+    with open(output_filename, 'w', newline='', buffering=1 << 20) as csvfile:
         writer = csv.writer(csvfile)
         
         # Write summary information
-        writer.writerow(['ECG Analysis Results'])
-        writer.writerow(['Sampling Rate (Hz)', sampling_rate])
-        writer.writerow(['Maternal Average Heart Rate (BPM)', f"{maternal_avg_hr:.1f}"])
-        writer.writerow(['Fetal Average Heart Rate (BPM)', f"{fetal_avg_hr:.1f}"])
-        writer.writerow(['Number of Maternal R Peaks', len(maternal_peaks)])
-        writer.writerow(['Number of Fetal R Peaks', len(fetal_peaks)])
-        writer.writerow([])
+        writer.writerows([
+            ['ECG Analysis Results'],
+            ['Sampling Rate (Hz)', sampling_rate],
+            ['Maternal Average Heart Rate (BPM)', f"{maternal_avg_hr:.1f}"],
+            ['Fetal Average Heart Rate (BPM)', f"{fetal_avg_hr:.1f}"],
+            ['Number of Maternal R Peaks', len(maternal_peaks)],
+            ['Number of Fetal R Peaks', len(fetal_peaks)],
+            [],
+        ])
         
         # Write maternal peaks
         writer.writerow(['Maternal R Peaks'])
         writer.writerow(['Index', 'Time (s)', 'Raw Value'])
-        for i, peak in enumerate(maternal_peaks):
-            writer.writerow([i+1, f"{t[peak]:.3f}", int(ecg_signal[peak])])
+        writer.writerows(zip(range(1, len(maternal_peaks) + 1),
+                             np.char.mod('%.3f', t[maternal_peaks]).tolist(),
+                             ecg_signal[maternal_peaks].astype(np.int32).tolist()))
         writer.writerow([])
         
         # Write fetal peaks
         writer.writerow(['Fetal R Peaks'])
         writer.writerow(['Index', 'Time (s)', 'Raw Value'])
-        for i, peak in enumerate(fetal_peaks):
-            writer.writerow([i+1, f"{t[peak]:.3f}", int(ecg_signal[peak])])
+        writer.writerows(zip(range(1, len(fetal_peaks) + 1),
+                             np.char.mod('%.3f', t[fetal_peaks]).tolist(),
+                             ecg_signal[fetal_peaks].astype(np.int32).tolist()))
         writer.writerow([])
         
         # Write heart rates
@@ -372,25 +536,15 @@ def save_results_to_csv(t, ecg_signal, maternal_peaks, fetal_peaks,
         writer.writerow(['Time (s)', 'Maternal HR (BPM)', 'Fetal HR (BPM)'])
         
         # Find the common time range
-        all_times = sorted(set(list(maternal_times) + list(fetal_times)))
+        all_times = np.union1d(maternal_times, fetal_times)
+        maternal_column = _align_heart_rates(all_times, maternal_times, maternal_heart_rates)
+        fetal_column = _align_heart_rates(all_times, fetal_times, fetal_heart_rates)
         
-        for time in all_times:
-            maternal_hr = 'N/A'
-            fetal_hr = 'N/A'
-            
-            # Find maternal heart rate at this time
-            for i, t in enumerate(maternal_times):
-                if abs(t - time) < 0.01:  # Within 10ms
-                    maternal_hr = f"{maternal_heart_rates[i]:.1f}"
-                    break
-            
-            # Find fetal heart rate at this time
-            for i, t in enumerate(fetal_times):
-                if abs(t - time) < 0.01:  # Within 10ms
-                    fetal_hr = f"{fetal_heart_rates[i]:.1f}"
-                    break
-            
-            writer.writerow([f"{time:.3f}", maternal_hr, fetal_hr])
+        writer.writerows([[f"{time:.3f}",
+                           'N/A' if np.isnan(maternal_hr) else f"{maternal_hr:.1f}",
+                           'N/A' if np.isnan(fetal_hr) else f"{fetal_hr:.1f}"]
+                          for time, maternal_hr, fetal_hr
+                          in zip(all_times, maternal_column, fetal_column)])
     
     print(f"Analysis results saved to {output_filename}")
 
@@ -405,6 +559,10 @@ if __name__ == "__main__":
                         help='Sampling rate in Hz (if not specified, will be estimated from the data)')
     parser.add_argument('--window-size', '-w', type=int, default=10,
                         help='Window size for heart rate calculation in seconds (default: 10)')
+    parser.add_argument('--plot-output', type=str, default=None,
+                        help='Save the plot to this image file instead of showing it')
+    parser.add_argument('--downsample', action='store_true',
+                        help='Detect peaks on a signal decimated to about 100 Hz (faster on long recordings)')
     
     args = parser.parse_args()
     
@@ -422,7 +580,7 @@ if __name__ == "__main__":
      maternal_heart_rates, fetal_heart_rates, 
      maternal_times, fetal_times, 
      maternal_avg_hr, fetal_avg_hr, 
-     lead_off_mask) = analyze_ecg(ecg, sampling_rate, args.window_size)
+     lead_off_spans) = analyze_ecg(ecg, sampling_rate, args.window_size, args.downsample)
     
     # Save results to CSV
     save_results_to_csv(t, ecg, maternal_peaks, fetal_peaks, 
@@ -435,4 +593,5 @@ if __name__ == "__main__":
     plot_analysis(t, ecg, maternal_peaks, fetal_peaks, 
                  maternal_heart_rates, fetal_heart_rates, 
                  maternal_times, fetal_times, 
-                 maternal_avg_hr, fetal_avg_hr, lead_off_mask) 
\ No newline at end of file
+                 maternal_avg_hr, fetal_avg_hr, lead_off_spans,
+                 output_image=args.plot_output) 
\ No newline at end of file
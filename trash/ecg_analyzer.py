@@ -1,8 +1,10 @@
 import numpy as np
 from scipy import signal
+from scipy.ndimage import uniform_filter1d
 import matplotlib.pyplot as plt
 import csv
 import argparse
+import itertools
 import os
 
 def detect_r_peaks(ecg_signal, sampling_rate, min_distance=0.4, threshold_factor=1.5, prominence_factor=1.0):
@@ -27,27 +29,23 @@ def detect_r_peaks(ecg_signal, sampling_rate, min_distance=0.4, threshold_factor
     peaks : array
         Indices of detected R peaks
     """
-    # Create a mask for valid data (not lead-off)
+    # Create a mask for valid data (not lead-off); lead-off samples are skipped
+    # through this mask rather than by copying the signal with NaN in their place
     valid_mask = ecg_signal > 0  # Values of 0 indicate lead-off in AD8232
     
-    # Work with valid data only
-    working_signal = np.copy(ecg_signal)
-    working_signal[~valid_mask] = np.nan
-    
     # Simple moving average to remove high-frequency noise
     window_size = int(0.02 * sampling_rate)  # 20ms window
     if window_size % 2 == 0:
         window_size += 1
     
-    # Pad the signal to handle edges
-    pad_width = window_size // 2
-    padded_signal = np.pad(working_signal, (pad_width, pad_width), mode='edge')
-    
-    # Apply moving average
-    smoothed = np.zeros_like(working_signal)
-    for i in range(len(working_signal)):
-        window = padded_signal[i:i + window_size]
-        smoothed[i] = np.nanmean(window)
+    # Apply moving average over the valid samples only: the windowed sum of the
+    # valid values divided by the windowed count of valid samples. Repeating the
+    # edge samples matches padding with the edge value; windows without any
+    # valid sample stay NaN.
+    valid_sum = uniform_filter1d(np.where(valid_mask, ecg_signal, 0.0), window_size, mode='nearest')
+    valid_count = uniform_filter1d(valid_mask.astype(ecg_signal.dtype), window_size, mode='nearest')
+    with np.errstate(invalid='ignore'):
+        smoothed = valid_sum / valid_count
     
     # Find peaks in the smoothed signal
     min_samples = int(min_distance * sampling_rate)
@@ -55,56 +53,60 @@ def detect_r_peaks(ecg_signal, sampling_rate, min_distance=0.4, threshold_factor
     # Use absolute threshold based on signal statistics
     valid_data = smoothed[~np.isnan(smoothed)]
     if len(valid_data) > 0:
-        # Calculate adaptive threshold
+        # Calculate adaptive threshold, and the lower one to fall back on
         signal_mean = np.mean(valid_data)
         signal_std = np.std(valid_data)
         peak_threshold = signal_mean + threshold_factor * signal_std
+        peak_prominence = signal_std * prominence_factor  # Minimum prominence
+        relaxed_threshold = signal_mean + (threshold_factor * 0.7) * signal_std
+        relaxed_prominence = signal_std * prominence_factor * 0.5
         
-        # Find peaks above threshold
+        # Find peaks once with the looser of both settings. find_peaks applies
+        # height before distance and prominence/width per peak, and the distance
+        # rule never lets a lower peak remove a higher one, so selecting by
+        # height and prominence afterwards is equivalent to a separate call per
+        # setting, except when peak heights tie (the distance rule's sort is not
+        # stable, so a tie may keep a different one of the peaks).
         peaks, properties = signal.find_peaks(
             smoothed,
             distance=min_samples,
-            height=peak_threshold,
-            prominence=signal_std * prominence_factor,  # Minimum prominence
+            height=min(peak_threshold, relaxed_threshold),
+            prominence=min(peak_prominence, relaxed_prominence),
             width=(0.02 * sampling_rate, 0.12 * sampling_rate)  # 20-120ms width
         )
+        heights = properties['peak_heights']
+        prominences = properties['prominences']
         
-        # If no peaks found, try with lower threshold
-        if len(peaks) == 0:
-            peak_threshold = signal_mean + (threshold_factor * 0.7) * signal_std
-            peaks, properties = signal.find_peaks(
-                smoothed,
-                distance=min_samples,
-                height=peak_threshold,
-                prominence=signal_std * prominence_factor * 0.5,
-                width=(0.02 * sampling_rate, 0.12 * sampling_rate)
-            )
+        # Keep the peaks above threshold, or the lower threshold if there are none
+        selected = (heights >= peak_threshold) & (prominences >= peak_prominence)
+        if not selected.any():
+            selected = (heights >= relaxed_threshold) & (prominences >= relaxed_prominence)
+        peaks = peaks[selected]
         
         # Refine peak locations
         if len(peaks) > 0:
-            refined_peaks = []
-            for peak in peaks:
-                # Look for maximum in original signal within ±50ms window
-                window_size = int(0.05 * sampling_rate)
-                start = max(0, peak - window_size)
-                end = min(len(working_signal), peak + window_size + 1)
-                # Get window of original signal
-                window = working_signal[start:end]
-                if not np.all(np.isnan(window)):  # Check if window has valid data
-                    local_max_idx = start + np.nanargmax(window)
-                    refined_peaks.append(local_max_idx)
-            
-            peaks = np.array(refined_peaks)
+            # Look for maximum in original signal within ±50ms window of every peak at once.
+            # Indices past either end are clipped to the end sample, which keeps each row
+            # in ascending order so argmax still picks the earliest maximum.
+            refine_width = int(0.05 * sampling_rate)
+            windows = np.clip(peaks[:, np.newaxis] + np.arange(-refine_width, refine_width + 1),
+                              0, len(ecg_signal) - 1)
+            window_valid = valid_mask[windows]
+            has_valid = window_valid.any(axis=1)  # Check if window has valid data
+            local_max = np.argmax(np.where(window_valid, ecg_signal[windows], -np.inf), axis=1)
+            peaks = windows[np.arange(len(peaks)), local_max][has_valid]
             
             # Additional filtering: remove peaks that are too low compared to neighbors
+            # (refined peaks always land on valid samples). R peak heights have a heavy
+            # upper tail, so use the robust lower fence of the quartiles (Q1 - 1.5 IQR)
+            # rather than mean - std.
             if len(peaks) > 2:
-                peak_values = working_signal[peaks]
-                peak_mean = np.nanmean(peak_values)
-                peak_std = np.nanstd(peak_values)
-                valid_peaks = peaks[peak_values > (peak_mean - peak_std)]
+                peak_values = ecg_signal[peaks]
+                q1, q3 = np.quantile(peak_values, [0.25, 0.75])
+                valid_peaks = peaks[peak_values >= q1 - 1.5 * (q3 - q1)]
                 peaks = valid_peaks
     else:
-        peaks = np.array([])
+        peaks = np.array([], dtype=int)
     
     return peaks
 
@@ -140,10 +142,13 @@ def calculate_heart_rate(peaks, sampling_rate, window_size=10):
     
     # Additional check for sudden large changes in intervals
     if len(rr_intervals) > 2:
-        # Calculate percentage change between adjacent intervals
-        interval_changes = np.abs(np.diff(rr_intervals)) / rr_intervals[:-1]
+        # Calculate percentage change between adjacent intervals, in place
+        # (peaks are distinct, so no interval is zero)
+        interval_changes = np.diff(rr_intervals)
+        np.abs(interval_changes, out=interval_changes)
+        interval_changes /= rr_intervals[:-1]
         # Mark intervals with sudden changes (>50%) as invalid
-        valid_intervals[1:] = valid_intervals[1:] & (interval_changes <= 0.5)
+        valid_intervals[1:] &= interval_changes <= 0.5
     
     rr_intervals = rr_intervals[valid_intervals]
     valid_peaks = peaks[1:][valid_intervals]
@@ -157,7 +162,8 @@ def calculate_heart_rate(peaks, sampling_rate, window_size=10):
     
     # Apply moving average with smaller window for better responsiveness
     if len(heart_rates) > 3:
-        heart_rates = np.convolve(heart_rates, np.ones(3)/3, mode='valid')
+        # 3-point average from shifted slices; cheaper than np.convolve for so short a kernel
+        heart_rates = (heart_rates[:-2] + heart_rates[1:-1] + heart_rates[2:]) / 3
         times = times[1:-1]
     
     return heart_rates, times
@@ -273,33 +279,14 @@ def plot_analysis(t, ecg_signal, peaks, heart_rates, times, avg_hr, lead_off_mas
     ax1.plot(plot_t, plot_signal, label='ECG', color='blue', linewidth=1)
     
     # Highlight lead-off periods
-    lead_off_periods = np.where(plot_mask)[0]
-    lead_off_plotted = False
-    if len(lead_off_periods) > 0:
-        # Group consecutive indices
-        lead_off_groups = []
-        current_group = [lead_off_periods[0]]
-        
-        for i in range(1, len(lead_off_periods)):
-            if lead_off_periods[i] == lead_off_periods[i-1] + 1:
-                current_group.append(lead_off_periods[i])
-            else:
-                lead_off_groups.append(current_group)
-                current_group = [lead_off_periods[i]]
-        
-        lead_off_groups.append(current_group)
-        
-        # Highlight each group
-        for group in lead_off_groups:
-            if len(group) > 0:
-                start_idx = group[0]
-                end_idx = group[-1] + 1
-                # Only add label for the first lead-off region
-                if not lead_off_plotted:
-                    ax1.axvspan(plot_t[start_idx], plot_t[end_idx-1], color='red', alpha=0.3, label='Lead Off')
-                    lead_off_plotted = True
-                else:
-                    ax1.axvspan(plot_t[start_idx], plot_t[end_idx-1], color='red', alpha=0.3)
+    # Runs of lead-off samples start where the mask steps up and end where it steps down
+    edges = np.diff(np.concatenate(([0], np.asarray(plot_mask, dtype=np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    for i, (start_idx, end_idx) in enumerate(zip(starts, ends)):
+        # Only add label for the first lead-off region
+        ax1.axvspan(plot_t[start_idx], plot_t[end_idx-1], color='red', alpha=0.3,
+                    label='Lead Off' if i == 0 else None)
     
     # Plot peaks
     if len(plot_peaks) > 0:
@@ -360,6 +347,19 @@ def plot_analysis(t, ecg_signal, peaks, heart_rates, times, avg_hr, lead_off_mas
     plt.subplots_adjust(left=0.1, right=0.95, top=0.95, bottom=0.1)
     plt.show()
 
+def _parse_csv_rows(lines, duration):
+    """Parse time/value rows one at a time, stopping at the first time past duration."""
+    rows = []
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        time = float(row[0])
+        if time > duration:
+            rows.append((time, np.nan))
+            break
+        rows.append((time, float(row[1])))
+    return np.array(rows, dtype=float).reshape(-1, 2)
+
 def load_ecg_from_csv(filename, duration=10.0):
     """
     Load ECG data from a CSV file.
@@ -380,21 +380,44 @@ def load_ecg_from_csv(filename, duration=10.0):
     sampling_rate : int
         Estimated sampling rate in Hz
     """
-    t = []
-    ecg = []
-    
+    # Parse the time and raw ADC columns in blocks of rows, stopping at the first
+    # sample past the requested duration so the rest of a long capture is never read
+    t_blocks = []
+    ecg_blocks = []
+    rows_read = 0
+    block_rows = 1024
     with open(filename, 'r', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        next(reader)  # Skip header row
-        for row in reader:
-            time = float(row[0])
-            if time > duration:  # Stop reading after duration
+        next(csvfile, None)  # Skip header row
+        while True:
+            lines = list(itertools.islice(csvfile, block_rows))
+            if not lines:
+                break
+            try:
+                block = np.loadtxt(lines, delimiter=',', usecols=(0, 1), ndmin=2)
+            except (ValueError, IndexError):
+                # A malformed row, e.g. a partial last row of an interrupted capture;
+                # go row by row so rows past duration are never parsed, as before
+                block = _parse_csv_rows(lines, duration)
+            if not block.size:
+                continue
+            
+            # Keep everything before the first sample past the requested duration
+            past_duration = np.flatnonzero(block[:, 0] > duration)
+            end = past_duration[0] if past_duration.size else len(block)
+            t_blocks.append(block[:end, 0])
+            ecg_blocks.append(block[:end, 1].astype(np.float32))  # Raw ADC value, 12-bit so float32 is exact
+            rows_read += end
+            if past_duration.size:
                 break
-            t.append(time)
-            ecg.append(float(row[1]))  # Raw ADC value
+            
+            # Size the next block from the sample rate so far to just reach duration
+            elapsed = t_blocks[-1][-1] - t_blocks[0][0] if rows_read else 0
+            if elapsed > 0:
+                remaining = (duration - t_blocks[-1][-1]) * (rows_read - 1) / elapsed
+                block_rows = max(1024, int(remaining * 1.1) + 1)
     
-    t = np.array(t)
-    ecg = np.array(ecg)
+    t = np.concatenate(t_blocks) if t_blocks else np.array([])
+    ecg = np.concatenate(ecg_blocks) if ecg_blocks else np.array([], dtype=np.float32)
     
     # Estimate sampling rate
     if len(t) > 1:
@@ -411,28 +434,32 @@ def load_ecg_from_csv(filename, duration=10.0):
 def save_results_to_csv(t, ecg_signal, peaks, heart_rates, times, avg_hr, 
                        sampling_rate, output_filename="ecg_analysis_results.csv"):
     """Save analysis results to a CSV file."""
-    with open(output_filename, 'w', newline='') as csvfile:
+    # Build each section in memory and hand it to the writer in one call
+    with open(output_filename, 'w', newline='', buffering=1 << 20) as csvfile:
         writer = csv.writer(csvfile)
         
         # Write summary information
-        writer.writerow(['ECG Analysis Results'])
-        writer.writerow(['Sampling Rate (Hz)', sampling_rate])
-        writer.writerow(['Average Heart Rate (BPM)', f"{avg_hr:.1f}"])
-        writer.writerow(['Number of R Peaks', len(peaks)])
-        writer.writerow([])
+        writer.writerows([
+            ['ECG Analysis Results'],
+            ['Sampling Rate (Hz)', sampling_rate],
+            ['Average Heart Rate (BPM)', f"{avg_hr:.1f}"],
+            ['Number of R Peaks', len(peaks)],
+            [],
+        ])
         
         # Write R peaks
         writer.writerow(['R Peaks'])
         writer.writerow(['Index', 'Time (s)', 'Raw Value'])
-        for i, peak in enumerate(peaks):
-            writer.writerow([i+1, f"{t[peak]:.3f}", int(ecg_signal[peak])])
+        writer.writerows(zip(range(1, len(peaks) + 1),
+                             np.char.mod('%.3f', t[peaks]).tolist(),
+                             ecg_signal[peaks].astype(np.int64).tolist()))
         writer.writerow([])
         
         # Write heart rates
         writer.writerow(['Heart Rates'])
         writer.writerow(['Time (s)', 'Heart Rate (BPM)'])
-        for i in range(len(times)):
-            writer.writerow([f"{times[i]:.3f}", f"{heart_rates[i]:.1f}"])
+        writer.writerows(zip(np.char.mod('%.3f', times).tolist(),
+                             np.char.mod('%.1f', heart_rates).tolist()))
     
     print(f"Analysis results saved to {output_filename}")
 
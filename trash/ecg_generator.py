@@ -1,78 +1,105 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import signal
-import csv
 import os
+from functools import lru_cache
+
+# P, Q, R, S and T waves as Gaussians: centre and width as a fraction of the beat
+# period, and height relative to the R wave (negative for the Q and S dips).
+# float32 like the waveforms built from them: plenty for a simulated 10-bit ADC
+WAVE_PEAKS = np.array([0.2, 0.4, 0.5, 0.6, 0.8], dtype=np.float32)
+WAVE_WIDTHS = np.array([0.1, 0.05, 0.05, 0.05, 0.15], dtype=np.float32)
+WAVE_HEIGHTS = np.array([0.25, -0.1, 1.0, -0.1, 0.35], dtype=np.float32)
+
+# One PCG64 generator shared by all the noise and heart rate variability draws
+_rng = np.random.default_rng()
 
 def generate_ecg_waveform(t, period, sampling_rate, amplitude=1.0, phase_shift=0):
-    """Generate a realistic ECG waveform for a single beat."""
-    # Normalize time to one period
-    t_norm = (t - phase_shift) % period / period
+    """
+    Generate a realistic ECG waveform for a single beat.
+    
+    period, amplitude and phase_shift may also be arrays with one entry per
+    sample of t, so that a whole train of different beats is built in one call.
+    """
+    # Normalize time to one period (the phase within a beat needs no more than float32)
+    t_norm = ((t - phase_shift) % period / period).astype(np.float32)
     
     # Create the basic ECG shape using a combination of Gaussian functions
+    # (P wave, QRS complex and T wave), evaluated in place in one scratch buffer
     ecg = np.zeros_like(t_norm)
-    
-    # P wave (atrial depolarization)
-    p_peak = 0.2
-    p_width = 0.1
-    ecg += 0.25 * amplitude * np.exp(-(t_norm - p_peak)**2 / (2 * p_width**2))
-    
-    # QRS complex
-    # Q wave
-    q_peak = 0.4
-    q_width = 0.05
-    ecg -= 0.1 * amplitude * np.exp(-(t_norm - q_peak)**2 / (2 * q_width**2))
-    
-    # R wave
-    r_peak = 0.5
-    r_width = 0.05
-    ecg += amplitude * np.exp(-(t_norm - r_peak)**2 / (2 * r_width**2))
-    
-    # S wave
-    s_peak = 0.6
-    s_width = 0.05
-    ecg -= 0.1 * amplitude * np.exp(-(t_norm - s_peak)**2 / (2 * s_width**2))
-    
-    # T wave
-    t_peak = 0.8
-    t_width = 0.15
-    ecg += 0.35 * amplitude * np.exp(-(t_norm - t_peak)**2 / (2 * t_width**2))
+    wave = np.empty_like(t_norm)
+    for peak, width, height in zip(WAVE_PEAKS, WAVE_WIDTHS, WAVE_HEIGHTS):
+        np.subtract(t_norm, peak, out=wave)
+        wave *= wave
+        wave *= -0.5 / (width * width)
+        np.exp(wave, out=wave)
+        wave *= height * amplitude
+        ecg += wave
     
     return ecg
 
 def add_baseline_wander(t, amplitude=0.1, frequency=0.5):
     """Add realistic baseline wander."""
-    return amplitude * np.sin(2 * np.pi * frequency * t)
+    return amplitude * np.sin(2 * np.pi * frequency * t, dtype=np.float32)
+
+@lru_cache(maxsize=8)
+def _muscle_noise_sos(sampling_rate):
+    """Design (and cache) the float32 20-60 Hz muscle noise bandpass in second-order sections."""
+    sos = signal.butter(4, [20/(sampling_rate/2), 60/(sampling_rate/2)], btype='band', output='sos')
+    return sos.astype(np.float32)
 
 def add_muscle_noise(t, sampling_rate, amplitude=0.05):
     """Add realistic muscle noise."""
-    noise = np.random.normal(0, 1, len(t))
-    # Filter to simulate muscle noise spectrum
-    b, a = signal.butter(4, [20/(sampling_rate/2), 60/(sampling_rate/2)], btype='band')
-    filtered_noise = signal.filtfilt(b, a, noise)
+    noise = _rng.standard_normal(len(t), dtype=np.float32)
+    # Filter to simulate muscle noise spectrum; the phase of random noise does
+    # not matter, so a single forward pass is enough
+    filtered_noise = signal.sosfilt(_muscle_noise_sos(sampling_rate), noise)
     return amplitude * filtered_noise
 
-def generate_maternal_ecg(duration, sampling_rate):
-    """Generate realistic maternal ECG signal."""
-    t = np.linspace(0, duration, int(duration * sampling_rate))
+def _draw_rr_intervals(duration, base_period, variability):
+    """Draw normally distributed RR intervals until together they cover duration."""
+    # Two spare beats almost always reach past the end; top up in the rare case they don't
+    rr_intervals = _rng.normal(base_period, variability, int(duration / base_period) + 2)
+    while rr_intervals.sum() < duration:
+        rr_intervals = np.append(rr_intervals, _rng.normal(base_period, variability, 2))
+    return rr_intervals
+
+def _beat_of_sample(t, cumulative_time):
+    """
+    Find which beat each sample belongs to.
+    
+    Beat i covers the samples from the end of beat i-1 up to cumulative_time[i],
+    so a beat running past the last sample is simply cut off there.
+    
+    Returns:
+    --------
+    beat : array
+        Beat index for each sample of t
+    """
+    return np.searchsorted(cumulative_time, t, side='right')
+
+def generate_maternal_ecg(duration, sampling_rate, out=None):
+    """Generate realistic maternal ECG signal, added into out if it is given."""
+    # Sample times on the 1/sampling_rate grid; kept in float64 so long recordings
+    # still resolve individual samples
+    t = np.arange(int(duration * sampling_rate)) / sampling_rate
     
     # Basic ECG parameters
     base_heart_rate = 75  # beats per minute
     base_period = 60 / base_heart_rate  # seconds per beat
     
     # Add heart rate variability
-    rr_intervals = np.random.normal(base_period, 0.02, int(duration / base_period))
+    rr_intervals = _draw_rr_intervals(duration, base_period, 0.02)
     cumulative_time = np.cumsum(rr_intervals)
     
-    # Generate ECG signal
-    ecg = np.zeros_like(t)
-    for i, interval in enumerate(rr_intervals):
-        if cumulative_time[i] > duration:
-            break
-        phase_shift = cumulative_time[i] - interval
-        ecg += generate_ecg_waveform(t, interval, sampling_rate, 
-                                   amplitude=1.0, 
-                                   phase_shift=phase_shift)
+    # Generate ECG signal (float32 is plenty for a simulated 12-bit ADC)
+    ecg = np.zeros(len(t), dtype=np.float32) if out is None else out
+    phase_shifts = cumulative_time - rr_intervals
+    # Give every sample the period and phase of its own beat and build all beats at once
+    beat = _beat_of_sample(t, cumulative_time)
+    ecg += generate_ecg_waveform(t, rr_intervals[beat], sampling_rate, 
+                                 amplitude=1.0, 
+                                 phase_shift=phase_shifts[beat])
     
     # Add baseline wander
     ecg += add_baseline_wander(t, amplitude=0.1, frequency=0.5)
@@ -82,41 +109,44 @@ def generate_maternal_ecg(duration, sampling_rate):
     
     return t, ecg
 
-def generate_fetal_ecg(duration, sampling_rate):
-    """Generate realistic fetal ECG signal."""
-    t = np.linspace(0, duration, int(duration * sampling_rate))
+def generate_fetal_ecg(duration, sampling_rate, out=None):
+    """Generate realistic fetal ECG signal, added into out if it is given."""
+    # Sample times on the 1/sampling_rate grid; kept in float64 so long recordings
+    # still resolve individual samples
+    t = np.arange(int(duration * sampling_rate)) / sampling_rate
     
     # Fetal ECG parameters (faster heart rate with more variability)
     base_heart_rate = 140  # beats per minute
     base_period = 60 / base_heart_rate  # seconds per beat
     
     # Add heart rate variability (more than maternal)
-    rr_intervals = np.random.normal(base_period, 0.03, int(duration / base_period))
+    rr_intervals = _draw_rr_intervals(duration, base_period, 0.03)
     cumulative_time = np.cumsum(rr_intervals)
     
-    # Generate ECG signal with variable amplitude
-    ecg = np.zeros_like(t)
-    for i, interval in enumerate(rr_intervals):
-        if cumulative_time[i] > duration:
-            break
-        phase_shift = cumulative_time[i] - interval
-        # Vary the amplitude to simulate fetal movement
-        amplitude = 0.3 * (1 + 0.2 * np.sin(2 * np.pi * 0.1 * cumulative_time[i]))
-        ecg += generate_ecg_waveform(t, interval, sampling_rate, 
-                                   amplitude=amplitude, 
-                                   phase_shift=phase_shift)
+    # Generate ECG signal with variable amplitude (float32 is plenty for a simulated 12-bit ADC)
+    ecg = np.zeros(len(t), dtype=np.float32) if out is None else out
+    phase_shifts = cumulative_time - rr_intervals
+    # Vary the amplitude to simulate fetal movement
+    amplitudes = 0.3 * (1 + 0.2 * np.sin(2 * np.pi * 0.1 * cumulative_time))
+    # Give every sample the period, phase and amplitude of its own beat and build all beats at once
+    beat = _beat_of_sample(t, cumulative_time)
+    ecg += generate_ecg_waveform(t, rr_intervals[beat], sampling_rate, 
+                                 amplitude=amplitudes[beat], 
+                                 phase_shift=phase_shifts[beat])
     
     # Add fetal-specific noise
     ecg += add_muscle_noise(t, sampling_rate, amplitude=0.03)
     
     return t, ecg
 
-def add_noise(signal, snr_db=20):
-    """Add Gaussian noise to the signal with specified SNR."""
+def add_noise(signal, snr_db=20, out=None):
+    """Add Gaussian noise to the signal with specified SNR, in place if out is signal."""
     signal_power = np.mean(signal ** 2)
     noise_power = signal_power / (10 ** (snr_db / 10))
-    noise = np.random.normal(0, np.sqrt(noise_power/2), len(signal))
-    return signal + noise
+    # Scale the noise in place rather than allocating the scaled copy separately
+    noise = _rng.standard_normal(len(signal), dtype=np.float32)
+    noise *= np.sqrt(noise_power/2)
+    return np.add(signal, noise, out=out)
 
 def simulate_ad8232_output(ecg_signal, sampling_rate, vcc=3.3, vref=1.65, 
                           lead_off_detection=False, lead_off_duration=0.5, 
@@ -155,21 +185,20 @@ def simulate_ad8232_output(ecg_signal, sampling_rate, vcc=3.3, vref=1.65,
     # AD8232 outputs around Vref when no signal is present
     # and varies by approximately ±1V for typical ECG signals
     max_amplitude = 1.0  # Maximum expected ECG amplitude in mV
-    scaled_signal = ecg_signal * (1.0 / max_amplitude)  # Scale to ±1V range
-    
-    # Apply gain
-    amplified_signal = scaled_signal * gain / 1000  # Convert to V
-    
-    # Center around Vref
-    centered_signal = amplified_signal + vref
-    
-    # Clip to VCC and GND
-    clipped_signal = np.clip(centered_signal, 0, vcc)
     
     # Add some quantization noise (AD8232 has 10-bit ADC)
     quantization_levels = 2**10
     quantization_step = vcc / quantization_levels
-    quantized_signal = np.round(clipped_signal / quantization_step) * quantization_step
+    
+    # Scale to ±1V, apply the gain (converting to V) and center around Vref,
+    # working directly in ADC steps so the rest can be done in place
+    quantized_signal = ecg_signal * (gain / 1000 / max_amplitude / quantization_step)
+    quantized_signal += vref / quantization_step
+    
+    # Clip to VCC and GND, round to whole steps and convert back to volts
+    np.clip(quantized_signal, 0, quantization_levels, out=quantized_signal)
+    np.rint(quantized_signal, out=quantized_signal)
+    quantized_signal *= quantization_step
     
     # Simulate lead-off detection
     lead_off_status = np.ones_like(quantized_signal)
@@ -192,16 +221,13 @@ def generate_combined_ecg(duration=10, sampling_rate=1000, snr_db=20,
                          lead_off_start=5.0):
     """Generate combined maternal and fetal ECG with realistic noise."""
     # Generate maternal ECG
-    t, maternal_ecg = generate_maternal_ecg(duration, sampling_rate)
+    t, combined_ecg = generate_maternal_ecg(duration, sampling_rate)
     
-    # Generate fetal ECG
-    _, fetal_ecg = generate_fetal_ecg(duration, sampling_rate)
-    
-    # Combine signals
-    combined_ecg = maternal_ecg + fetal_ecg
+    # Generate fetal ECG, combining the signals by adding it into the same buffer
+    generate_fetal_ecg(duration, sampling_rate, out=combined_ecg)
     
     # Add measurement noise
-    noisy_ecg = add_noise(combined_ecg, snr_db)
+    noisy_ecg = add_noise(combined_ecg, snr_db, out=combined_ecg)
     
     # Simulate AD8232 output
     ad8232_output, lead_off_status = simulate_ad8232_output(
@@ -228,15 +254,16 @@ def save_ecg_to_csv(t, ecg, lead_off_status, filename="ecg_data.csv"):
     filename : str
         Name of the CSV file to save
     """
+    # Convert ECG values to raw ADC values (0-4095 for 12-bit ADC)
+    # Assuming 3.3V reference voltage; astype truncates like int()
+    raw_values = ((np.asarray(ecg) / 3.3) * 4095).astype(np.int64)
+    
+    # Format time with 3 decimal places and no leading spaces, with the
+    # same header and CRLF line endings as before. The file is opened with
+    # newline='' so Windows doesn't turn the CRLF into CR CR LF.
     with open(filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['Time (s)', 'Raw ECG Value'])
-        for i in range(len(t)):
-            # Convert ECG value to raw ADC value (0-4095 for 12-bit ADC)
-            # Assuming 3.3V reference voltage
-            raw_value = int((ecg[i] / 3.3) * 4095)
-            # Format time with 3 decimal places and no leading spaces
-            writer.writerow([f"{t[i]:.3f}", raw_value])
+        np.savetxt(csvfile, np.column_stack((t, raw_values)), fmt=('%.3f', '%d'),
+                   delimiter=',', newline='\r\n', header='Time (s),Raw ECG Value', comments='')
     
     print(f"ECG data saved to {filename}")
 
@@ -258,26 +285,20 @@ def load_ecg_from_csv(filename):
     lead_off_status : array
         Lead-off detection status
     """
-    t = []
-    ecg = []
-    lead_off_status = []
-    
-    with open(filename, 'r', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        next(reader)  # Skip header row
-        for row in reader:
-            t.append(float(row[0]))
-            # Convert raw ADC value back to voltage
-            # Assuming 3.3V reference voltage and 12-bit ADC
-            raw_value = float(row[1])
-            voltage = (raw_value / 4095) * 3.3
-            ecg.append(voltage)
-            if len(row) > 2:
-                lead_off_status.append(float(row[2]))
-            else:
-                lead_off_status.append(1.0)  # Default to leads connected
-    
-    return np.array(t), np.array(ecg), np.array(lead_off_status)
+    # Parse all columns in one pass, skipping the header row
+    data = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2)
+    t = data[:, 0]
+    
+    # Convert raw ADC values back to voltage
+    # Assuming 3.3V reference voltage and 12-bit ADC
+    ecg = (data[:, 1] / 4095) * 3.3
+    
+    if data.shape[1] > 2:
+        lead_off_status = data[:, 2]
+    else:
+        lead_off_status = np.ones(len(t))  # Default to leads connected
+    
+    return t, ecg, lead_off_status
 
 if __name__ == "__main__":
     # Generate and plot the signal
@@ -299,27 +320,12 @@ if __name__ == "__main__":
     ax1.grid(True)
     
     # Highlight lead-off detection periods
-    lead_off_periods = np.where(lead_off_status == 0)[0]
-    if len(lead_off_periods) > 0:
-        # Group consecutive indices
-        lead_off_groups = []
-        current_group = [lead_off_periods[0]]
-        
-        for i in range(1, len(lead_off_periods)):
-            if lead_off_periods[i] == lead_off_periods[i-1] + 1:
-                current_group.append(lead_off_periods[i])
-            else:
-                lead_off_groups.append(current_group)
-                current_group = [lead_off_periods[i]]
-        
-        lead_off_groups.append(current_group)
-        
-        # Highlight each group
-        for group in lead_off_groups:
-            if len(group) > 0:
-                start_idx = group[0]
-                end_idx = group[-1] + 1
-                ax1.axvspan(t[start_idx], t[end_idx-1], color='red', alpha=0.3)
+    # Runs of lead-off samples start where the mask steps up and end where it steps down
+    edges = np.diff(np.concatenate(([0], (lead_off_status == 0).astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    for start_idx, end_idx in zip(starts, ends):
+        ax1.axvspan(t[start_idx], t[end_idx-1], color='red', alpha=0.3)
     
     # Plot lead-off status
     ax2.plot(t, lead_off_status, 'g-', linewidth=2)